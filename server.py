@@ -1,123 +1,382 @@
 # stdlib imports
-import json
+import functools
+import hashlib
+import multiprocessing
+import socketserver
+import sys
+import threading
 import tomllib
 import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from xmlrpc.server import SimpleXMLRPCServer
 from xmlrpc.server import SimpleXMLRPCRequestHandler
 
+# third-party imports
+import orjson
+
 # parser imports
 import mwparserfromhell
 from mwparserfromhell import nodes
 from mwparserfromhell.nodes import Node
+from mwparserfromhell.parser import CTokenizer
+
+# The pure-Python tokenizer is an order of magnitude slower; refuse to start
+# rather than silently falling back to it.
+if CTokenizer is None:
+    raise ImportError(
+        "mwparserfromhell was installed without its C tokenizer; "
+        "install a binary wheel or build it from source with a C compiler"
+    )
+
+def wikicode_str(wikitext: mwparserfromhell.wikicode.Wikicode, _cache: dict[int, dict]) -> str:
+    # str() on Wikicode walks the whole subtree again; plain names and values
+    # are a single Text node whose value is already the answer, and anything
+    # else is joined from the (cached) text of its converted nodes.
+    children = wikitext.nodes
+    if len(children) == 1 and isinstance(children[0], nodes.Text):
+        return children[0].value
+    return "".join(node_text(child, _cache) for child in children)
+
+def node_text(node: Node, _cache: dict[int, dict]) -> str:
+    return convert_node(node, _cache)["text"]
+
+def convert_wikicode_fast(wikitext: mwparserfromhell.wikicode.Wikicode, _cache: dict[int, dict]):
+    # Names, titles, urls and simple values are usually a single Text node;
+    # build the result directly instead of walking and converting for nothing.
+    children = wikitext.nodes
+    if len(children) == 1 and isinstance(children[0], nodes.Text):
+        value = children[0].value
+        return {
+            "headings": [],
+            "templates": [],
+            "tags": [],
+            "nodes": [{"text": value, "type": "Text", "value": value}],
+            "text": value,
+        }
+    return convert_wikicode(wikitext, _cache)
+
+def convert_node(node: Node, _cache: dict[int, dict]):
+    # The same subtree is reached both through its parent and through the
+    # heading/template/tag walk, so convert each node only once per parse.
+    result = _cache.get(id(node))
+    if result is not None:
+        return result
+    result = _convert_node(node, _cache)
+    _cache[id(node)] = result
+    return result
+
+# Each handler assembles its node's text from its children's converted text
+# (the same way the node's __str__ does) so every subtree is stringified once,
+# rather than once per ancestor.
+def _convert_attribute(node: nodes.extras.Attribute, _cache: dict[int, dict]):
+    value = convert_wikicode_fast(node.value, _cache) if node.value is not None else None
+    text = node.pad_first + wikicode_str(node.name, _cache) + node.pad_before_eq
+    if value is not None:
+        quotes = node.quotes or ""
+        text += "=" + node.pad_after_eq + quotes + value["text"] + quotes
+    return {
+        "text": text,
+        "type": "Attribute",
+        "pad_after_eq": node.pad_after_eq,
+        "pad_before_eq": node.pad_before_eq,
+        "pad_first": node.pad_first,
+        "quotes": node.quotes if node.quotes is not None else None,
+        "value": value,
+    }
+
+def _convert_parameter(node: nodes.extras.Parameter, _cache: dict[int, dict]):
+    name = wikicode_str(node.name, _cache)
+    value = wikicode_str(node.value, _cache) if node.value is not None else None
+    text = value or ""
+    if node.showkey:
+        text = f"{name}={text}"
+    return {
+        "text": text,
+        "name": name,
+        "type": "Parameter",
+        "showkey": node.showkey,
+        "value": value,
+    }
+
+def _convert_argument(node: nodes.Argument, _cache: dict[int, dict]):
+    name = convert_wikicode_fast(node.name, _cache)
+    default = convert_wikicode_fast(node.default, _cache) if node.default is not None else None
+    if default is not None:
+        text = "{{{" + name["text"] + "|" + default["text"] + "}}}"
+    else:
+        text = "{{{" + name["text"] + "}}}"
+    return {
+        "text": text,
+        "type": "Argument",
+        "name": name,
+        "default": default,
+    }
+
+def _convert_comment(node: nodes.Comment, _cache: dict[int, dict]):
+    return {
+        "text": str(node),
+        "type": "Comment",
+        "contents": str(node.contents)
+    }
+
+def _convert_external_link(node: nodes.ExternalLink, _cache: dict[int, dict]):
+    title = convert_wikicode_fast(node.title, _cache) if node.title is not None else None
+    url = convert_wikicode_fast(node.url, _cache)
+    if not node.brackets:
+        text = url["text"]
+    elif title is None:
+        text = "[" + url["text"] + "]"
+    else:
+        separator = "" if node.suppress_space is True else " "
+        text = "[" + url["text"] + separator + title["text"] + "]"
+    return {
+        "text": text,
+        "type": "ExternalLink",
+        "brackets": node.brackets,
+        "title": title,
+        "url": url,
+    }
+
+def _convert_heading(node: nodes.Heading, _cache: dict[int, dict]):
+    title = convert_wikicode_fast(node.title, _cache)
+    markup = "=" * node.level
+    return {
+        "text": markup + title["text"] + markup,
+        "type": "Heading",
+        "level": node.level,
+        "title": title,
+    }
+
+def _convert_html_entity(node: nodes.HTMLEntity, _cache: dict[int, dict]):
+    return {
+        "text": str(node),
+        "type": "HTMLEntity",
+        "hex_char": node.hex_char,
+        "hexadecimal": node.hexadecimal,
+        "named": node.named,
+        "value": node.value,
+    }
+
+def _convert_tag(node: nodes.Tag, _cache: dict[int, dict]):
+    attributes = [convert_node(n, _cache) for n in node.attributes]
+    contents = convert_wikicode_fast(node.contents, _cache)
+    # Wikicode's truthiness stringifies the whole subtree, so check for None
+    # and let the converted text decide emptiness (empty fields stay None).
+    closing_tag = wikicode_str(node.closing_tag, _cache) if node.closing_tag is not None else None
+    closing_tag = closing_tag or None
+    closing_wiki_markup = node.closing_wiki_markup
+    tag = wikicode_str(node.tag, _cache) if node.tag is not None else None
+    tag = tag or None
+    wiki_markup = node.wiki_markup
+    wiki_style_separator = node.wiki_style_separator
+    attrs = "".join(attribute["text"] for attribute in attributes)
+    if wiki_markup:
+        text = wiki_markup + attrs + (node.padding or "") + (wiki_style_separator or "")
+        if not node.self_closing:
+            text += contents["text"] + (closing_wiki_markup or "")
+    else:
+        text = ("</" if node.invalid else "<") + (tag or "") + attrs
+        if node.self_closing:
+            text += node.padding + (">" if node.implicit else "/>")
+        else:
+            text += node.padding + ">" + contents["text"] + "</" + (closing_tag or "") + ">"
+    return {
+        "text": text,
+        "type": "Tag",
+        "attributes": attributes,
+        "closing_tag": closing_tag,
+        "closing_wiki_markup": str(closing_wiki_markup) if closing_wiki_markup else None,
+        "contents": contents,
+        "implicit": node.implicit,
+        "invalid": node.invalid,
+        "padding": node.padding,
+        "self_closing": node.self_closing,
+        "tag": tag,
+        "wiki_markup": str(wiki_markup) if wiki_markup else None,
+        "wiki_style_separator": str(wiki_style_separator) if wiki_style_separator else None,
+    }
+
+def _convert_template(node: nodes.Template, _cache: dict[int, dict]):
+    name = convert_wikicode_fast(node.name, _cache)
+    params = [convert_node(param, _cache) for param in node.params]
+    if params:
+        text = "{{" + name["text"] + "|" + "|".join(param["text"] for param in params) + "}}"
+    else:
+        text = "{{" + name["text"] + "}}"
+    return {
+        "text": text,
+        "type": "Template",
+        "name": name,
+        "params": params,
+    }
+
+def _convert_text(node: nodes.Text, _cache: dict[int, dict]):
+    return {
+        "text": node.value,
+        "type": "Text",
+        "value": node.value,
+    }
 
-def convert_node(node: Node):
-    match node:
-        case nodes.extras.Attribute():
-            return {
-                "text": str(node),
-                "type": "Attribute",
-                "pad_after_eq": node.pad_after_eq,
-                "pad_before_eq": node.pad_before_eq,
-                "pad_first": node.pad_first,
-                "quotes": node.quotes if node.quotes is not None else None,
-                "value": convert_wikicode(node.value) if node.value is not None else None,
-            }
-        case nodes.extras.Parameter():
-            return {
-                "text": str(node),
-                "name": str(node.name),
-                "type": "Parameter",
-                "showkey": node.showkey,
-                "value": str(node.value) if node.value is not None else None,
-            }
-        case nodes.Argument():
-            return {
-                "text": str(node),
-                "type": "Argument",
-                "name": convert_wikicode(node.name),
-                "default": convert_wikicode(node.default) if node.default is not None else None,
-            }
-        case nodes.Comment():
-            return {
-                "text": str(node),
-                "type": "Comment",
-                "contents": str(node.contents)
-            }
-        case nodes.ExternalLink():
-            return {
-                "text": str(node),
-                "type": "ExternalLink",
-                "brackets": node.brackets,
-                "title": convert_wikicode(node.title) if node.title is not None else None,
-                "url": convert_wikicode(node.url),
-            }
-        case nodes.Heading():
-            return {
-                "text": str(node),
-                "type": "Heading",
-                "level": node.level,
-                "title": convert_wikicode(node.title),
-            }
-        case nodes.HTMLEntity():
-            return {
-                "text": str(node),
-                "type": "HTMLEntity",
-                "hex_char": node.hex_char,
-                "hexadecimal": node.hexadecimal,
-                "named": node.named,
-                "value": node.value,
-            }
-        case nodes.Tag():
-            return {
-                "text": str(node),
-                "type": "Tag",
-                "attributes": [convert_node(n) for n in node.attributes],
-                "closing_tag": str(node.closing_tag) if node.closing_tag else None,
-                "closing_wiki_markup": str(node.closing_wiki_markup) if node.closing_wiki_markup else None,
-                "contents": convert_wikicode(node.contents),
-                "implicit": node.implicit,
-                "invalid": node.invalid,
-                "padding": node.padding,
-                "self_closing": node.self_closing,
-                "tag": str(node.tag) if node.tag else None,
-                "wiki_markup": str(node.wiki_markup) if node.wiki_markup else None,
-                "wiki_style_separator": str(node.wiki_style_separator) if node.wiki_style_separator else None,
-            }
-        case nodes.Template():
-            return {
-                "text": str(node),
-                "type": "Template",
-                "name": convert_wikicode(node.name),
-                "params": [convert_node(param) for param in node.params],
-            }
-        case nodes.Text():
-            return {
-                "text": str(node),
-                "type": "Text",
-                "value": str(node.value),
-            }
-        case nodes.Wikilink():
-            return {
-                "text": str(node),
-                "type": "Wikilink",
-                "txt": convert_wikicode(node.text) if node.text else None,
-                "title": convert_wikicode(node.title),
-            }
-        case _:
-            raise ValueError(f"Unsupported node type: {type(node)}")
-
-def convert_wikicode(wikitext: mwparserfromhell.wikicode.Wikicode):
+def _convert_wikilink(node: nodes.Wikilink, _cache: dict[int, dict]):
+    title = convert_wikicode_fast(node.title, _cache)
+    # Wikicode's truthiness stringifies the whole caption; check for None and
+    # drop an empty caption afterwards, as before.
+    txt = convert_wikicode_fast(node.text, _cache) if node.text is not None else None
+    if txt is not None and not txt["text"]:
+        txt = None
+    if node.text is not None:
+        text = "[[" + title["text"] + "|" + (txt["text"] if txt else "") + "]]"
+    else:
+        text = "[[" + title["text"] + "]]"
     return {
-        "headings": [convert_node(h) for h in wikitext.filter_headings()],
-        "templates": [convert_node(t) for t in wikitext.filter_templates()],
-        "tags": [convert_node(t) for t in wikitext.filter_tags()],
-        "nodes": [convert_node(n) for n in wikitext.nodes],
-        "text": str(wikitext),
+        "text": text,
+        "type": "Wikilink",
+        "txt": txt,
+        "title": title,
     }
 
+# Dispatch on the exact node type with one dict lookup instead of a chain of
+# isinstance checks; Text nodes (by far the most common) no longer pay for
+# every case listed before them.
+HANDLERS = {
+    nodes.extras.Attribute: _convert_attribute,
+    nodes.extras.Parameter: _convert_parameter,
+    nodes.Argument: _convert_argument,
+    nodes.Comment: _convert_comment,
+    nodes.ExternalLink: _convert_external_link,
+    nodes.Heading: _convert_heading,
+    nodes.HTMLEntity: _convert_html_entity,
+    nodes.Tag: _convert_tag,
+    nodes.Template: _convert_template,
+    nodes.Text: _convert_text,
+    nodes.Wikilink: _convert_wikilink,
+}
+
+def _convert_node(node: Node, _cache: dict[int, dict]):
+    handler = HANDLERS.get(type(node))
+    if handler is None:
+        raise ValueError(f"Unsupported node type: {type(node)}")
+    return handler(node, _cache)
+
+def walk(children: list[Node], headings: list, templates: list, tags: list, _cache: dict[int, dict]):
+    # One pre-order descent that matches what filter_headings/templates/tags
+    # would return (they recurse through __children__ too), so the tree is only
+    # walked once.
+    for node in children:
+        if isinstance(node, nodes.Heading):
+            headings.append(convert_node(node, _cache))
+        elif isinstance(node, nodes.Template):
+            templates.append(convert_node(node, _cache))
+        elif isinstance(node, nodes.Tag):
+            tags.append(convert_node(node, _cache))
+        for code in node.__children__():
+            walk(code.nodes, headings, templates, tags, _cache)
+
+def convert_wikicode(wikitext: mwparserfromhell.wikicode.Wikicode, _cache: dict[int, dict] | None = None):
+    # The cache keeps the converted dicts (and the tree keeps the nodes) alive
+    # for the whole parse, so node ids stay unique while it is in use.
+    if _cache is None:
+        _cache = {}
+    # Convert the top-level nodes first; the walk below only finds them again
+    # as cache hits.
+    children = wikitext.nodes
+    out_nodes = [convert_node(node, _cache) for node in children]
+    headings, templates, tags = [], [], []
+    walk(children, headings, templates, tags, _cache)
+    return {
+        "headings": headings,
+        "templates": templates,
+        "tags": tags,
+        "nodes": out_nodes,
+        "text": "".join(result["text"] for result in out_nodes),
+    }
+
+def parse_text(text: str) -> dict[str, str | float]:
+    t1 = time.time()
+    # Style tags ('' and ''') aren't used by the bot and are the most expensive
+    # part of tokenizing, so leave them as plain text.
+    wikitext = mwparserfromhell.parse(text, skip_style_tags=True)
+    output = convert_wikicode(wikitext)
+    t2 = time.time()
+    # The Rust client deserializes "parsed" from a JSON string (dxr can't map
+    # the tagged node structs), so keep the string but encode it with orjson.
+    # Returning the dict as a native XML-RPC struct isn't cheaper either: the
+    # pure-Python marshaller is ~3-4x slower than this and the payload is
+    # ~3-4x larger than the escaped JSON.
+    return {"parsed": orjson.dumps(output).decode(), "elapsed": t2 - t1}
+
+def parse_templates_text(text: str) -> dict[str, str | float]:
+    # Lighter variant of parse_text for callers that only read templates: no
+    # conversion of the rest of the page, just the (nested) templates.
+    t1 = time.time()
+    wikitext = mwparserfromhell.parse(text, skip_style_tags=True)
+    _cache = {}
+    output = [convert_node(template, _cache) for template in wikitext.filter_templates()]
+    t2 = time.time()
+    return {"parsed": orjson.dumps(output).decode(), "elapsed": t2 - t1}
+
+class ParseCache:
+    """LRU cache of parse results keyed by endpoint and a digest of the input.
+
+    The bot re-requests the same pages (retries, unchanged revisions), so this
+    turns a repeated parse into a dict lookup. The encoded results are far
+    larger than the page text (tens of times for a big article), so the cache
+    is bounded by the memory taken by the cached "parsed" strings (as reported
+    by sys.getsizeof, so non-ASCII pages count for what they really use) rather
+    than by entry count, and parse and parse_templates share the one budget.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: OrderedDict[tuple[str, bytes], dict[str, str | float]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(kind: str, text: str) -> tuple[str, bytes]:
+        return kind, hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+    def get(self, key: tuple[str, bytes]) -> dict[str, str | float] | None:
+        with self.lock:
+            result = self.entries.get(key)
+            if result is not None:
+                self.entries.move_to_end(key)
+            return result
+
+    def put(self, key: tuple[str, bytes], result: dict[str, str | float]):
+        size = sys.getsizeof(result["parsed"])
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= sys.getsizeof(old["parsed"])
+            self.entries[key] = result
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= sys.getsizeof(evicted["parsed"])
+
 # Load configuration
+@functools.cache
+def load_config(path: str) -> dict:
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+
 config_path = "conf/main.toml"
-config = tomllib.load(open(config_path, "rb"))
+config = load_config(config_path)
+
+# Shared by parse and parse_templates; set rpc.cache_max_bytes to change it.
+# The bot job has 2G of memory for this server, its workers and the Rust bot.
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Number of parser processes; set rpc.workers to change it. os.cpu_count()
+# reports the host's cores rather than the job's CPU quota, so don't size the
+# pool from it.
+DEFAULT_WORKERS = 2
 
 
 # Restrict to a particular path.
@@ -125,21 +384,121 @@ class RequestHandler(SimpleXMLRPCRequestHandler):
     rpc_paths = (config["rpc"]["path"],)
 
 
-# Create server
-print(f"Starting XML-RPC server on port {config['rpc']['port']}...")
-with SimpleXMLRPCServer(
-    ("localhost", config["rpc"]["port"]), requestHandler=RequestHandler, allow_none=True
-) as server:
-    server.register_introspection_functions()
+class WorkerPool:
+    """ProcessPoolExecutor that is rebuilt when one of its workers dies.
+
+    A worker that is OOM-killed or crashes leaves a ProcessPoolExecutor broken
+    for good, so every later call would fail; instead replace the executor and
+    retry the call once.
+    """
+
+    def __init__(self, max_workers: int):
+        self.lock = threading.Lock()
+        self.max_workers = max_workers
+        self.executor = self.create_executor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown()
+
+    def create_executor(self) -> ProcessPoolExecutor:
+        # Workers are started lazily from request handler threads (and rebuilt
+        # from them), and fork() in a multi-threaded process can hand the child
+        # a lock some other thread was holding. Start them from a forkserver.
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=multiprocessing.get_context("forkserver")
+        )
+
+    def restart(self, broken: ProcessPoolExecutor):
+        with self.lock:
+            # Every in-flight call sees the same broken executor; rebuild it once.
+            if self.executor is broken:
+                print("A parser worker died; restarting the process pool")
+                broken.shutdown(wait=False, cancel_futures=True)
+                self.executor = self.create_executor()
+
+    def submit(self, fn, text: str):
+        executor = self.executor
+        try:
+            return executor, executor.submit(fn, text)
+        except BrokenProcessPool:
+            self.restart(executor)
+            return None, self.executor.submit(fn, text)
+
+    def result(self, submitted, fn, text: str) -> dict[str, str | float]:
+        executor, future = submitted
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            # executor is None when this call was already retried at submit time.
+            if executor is None:
+                raise
+            self.restart(executor)
+            return self.executor.submit(fn, text).result()
+
+    def run(self, fn, text: str) -> dict[str, str | float]:
+        return self.result(self.submit(fn, text), fn, text)
+
+
+# Handle each request on its own thread so one slow page doesn't block the rest.
+class ThreadedXMLRPCServer(socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    # Parsing is pure Python and holds the GIL, so run it in worker processes.
+    with WorkerPool(config["rpc"].get("workers", DEFAULT_WORKERS)) as pool:
+        # Create server
+        print(f"Starting XML-RPC server on port {config['rpc']['port']}...")
+        with ThreadedXMLRPCServer(
+            ("localhost", config["rpc"]["port"]), requestHandler=RequestHandler, allow_none=True
+        ) as server:
+            server.register_introspection_functions()
+
+            cache = ParseCache(config["rpc"].get("cache_max_bytes", DEFAULT_CACHE_MAX_BYTES))
+
+            def cache_hit(result: dict[str, str | float], t1: float) -> dict[str, str | float]:
+                # Report the time spent on the lookup, not the original parse.
+                return {"parsed": result["parsed"], "elapsed": time.time() - t1}
+
+            def cached_parse(kind: str, parse, text: str) -> dict[str, str | float]:
+                t1 = time.time()
+                key = cache.key(kind, text)
+                result = cache.get(key)
+                if result is not None:
+                    return cache_hit(result, t1)
+                result = pool.run(parse, text)
+                cache.put(key, result)
+                return result
+
+            def parser(text: str) -> dict[str, str | float]:
+                return cached_parse("parse", parse_text, text)
+
+            def parser_templates(text: str) -> dict[str, str | float]:
+                return cached_parse("parse_templates", parse_templates_text, text)
 
-    def parser(text: str) -> dict[str, str | float]:
-        t1 = time.time()
-        wikitext = mwparserfromhell.parse(text)
-        output = convert_wikicode(wikitext)
-        t2 = time.time()
-        return {"parsed": json.dumps(output), "elapsed": t2 - t1}
+            def parser_batch(texts: list[str]) -> list[dict[str, str | float]]:
+                # One round trip for many pages; every uncached page is submitted
+                # before waiting so the whole pool works on the batch at once.
+                t1 = time.time()
+                keys = [cache.key("parse", text) for text in texts]
+                results = [cache.get(key) for key in keys]
+                results = [cache_hit(result, t1) if result is not None else None for result in results]
+                pending = {}
+                for text, key, result in zip(texts, keys, results):
+                    if result is None and key not in pending:
+                        pending[key] = pool.submit(parse_text, text)
+                for i, (text, key) in enumerate(zip(texts, keys)):
+                    if results[i] is None:
+                        results[i] = pool.result(pending[key], parse_text, text)
+                        cache.put(key, results[i])
+                return results
 
-    server.register_function(parser, "parse")
+            server.register_function(parser, "parse")
+            server.register_function(parser_batch, "parse_batch")
+            server.register_function(parser_templates, "parse_templates")
 
-    # Run the server's main loop
-    server.serve_forever()
+            # Run the server's main loop
+            server.serve_forever()